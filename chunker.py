@@ -1,8 +1,18 @@
+def iter_chunks(texts, chunk_size=512, overlap=30):
+    """Chunk an iterable of text pieces as if they were one string, without joining them."""
+    buffer = ""
+    for text in texts:
+        buffer += text
+        start = 0
+        while len(buffer) - start >= chunk_size:
+            yield buffer[start:start + chunk_size]
+            start += chunk_size - overlap
+        # Keep only the unconsumed tail (it includes the overlap) for the next piece
+        buffer = buffer[start:]
+    # Like chunk_text, keep stepping through the tail with shorter chunks
+    for start in range(0, len(buffer), chunk_size - overlap):
+        yield buffer[start:start + chunk_size]
+
+
 def chunk_text(text, chunk_size=512, overlap=30):
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start = end - overlap
-    return chunks 
\ No newline at end of file
+    return list(iter_chunks([text], chunk_size, overlap))
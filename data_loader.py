@@ -1,13 +1,17 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import fitz
 
 
-def load_text_from_pdf(pdf_path):
-    text = ""
+def iter_text_from_pdf(pdf_path):
     with fitz.open(pdf_path) as pdf_file:
-        for page_num in range(len(pdf_file)):
-            page = pdf_file.load_page(page_num)
-            text += page.get_text()
-    return text
+        for page in pdf_file.pages():
+            yield page.get_text()
+
+
+def load_text_from_pdf(pdf_path):
+    return "".join(iter_text_from_pdf(pdf_path))
 
 
 def load_text_from_txt(txt_path):
@@ -15,12 +19,27 @@ def load_text_from_txt(txt_path):
         return f.read()
 
 
-def load_corpus(sources):
-    corpus = ""
-    for source in sources:
-        if source.endswith('.pdf'):
-            corpus += load_text_from_pdf(source)
-        elif source.endswith('.txt'):
-            corpus += load_text_from_txt(source)
-        # Add more formats as needed
-    return corpus 
\ No newline at end of file
+def load_source(source):
+    if source.endswith('.pdf'):
+        return load_text_from_pdf(source)
+    elif source.endswith('.txt'):
+        return load_text_from_txt(source)
+    # Add more formats as needed
+    return ""
+
+
+def iter_corpus(sources, max_workers=None):
+    """Yield the corpus one source at a time instead of as one string."""
+    if len(sources) <= 1:
+        yield from (load_source(source) for source in sources)
+        return
+    if max_workers is None:
+        max_workers = min(os.cpu_count() or 1, 4)
+    # PDF parsing is CPU-bound C code; one process per file scales it across cores,
+    # and map still hands results back in source order as they finish
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(load_source, sources)
+
+
+def load_corpus(sources, max_workers=None):
+    return "".join(iter_corpus(sources, max_workers))
@@ -0,0 +1,75 @@
+import os
+from array import array
+from collections.abc import Sequence
+
+import numpy as np
+
+
+def _write_offsets(offsets, offsets_path):
+    # Readers only see documents the offsets point to, so publishing them atomically
+    # is what makes a save or an append visible
+    tmp_path = f"{offsets_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, offsets)
+    os.replace(tmp_path, offsets_path)
+
+
+def _write_blob(f, documents, start):
+    """Write documents (any iterable) to f and return their offsets after start."""
+    # Only the offsets grow with the corpus, at 8 bytes per document
+    ends = array('q')
+    end = start
+    for document in documents:
+        encoded = document.encode('utf-8')
+        f.write(encoded)
+        end += len(encoded)
+        ends.append(end)
+    return np.array(ends, dtype=np.int64)
+
+
+def save_documents(documents, data_path, offsets_path):
+    """Write documents as one UTF-8 blob plus an int64 table of byte offsets.
+
+    documents may be a generator; it is consumed once and never held in memory.
+    """
+    # A new file is renamed into place, so processes mapping the old blob keep a valid mapping
+    tmp_path = f"{data_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        ends = _write_blob(f, documents, 0)
+    os.replace(tmp_path, data_path)
+    _write_offsets(np.concatenate(([0], ends)), offsets_path)
+
+
+def append_documents(documents, data_path, offsets_path):
+    """Append documents to a saved table without rewriting the existing ones."""
+    old_offsets = np.load(offsets_path)
+    with open(data_path, 'r+b') as f:
+        # Never truncate (that would break other processes' mappings); bytes past the
+        # last offset are leftovers of an interrupted append and are simply overwritten
+        f.seek(int(old_offsets[-1]))
+        ends = _write_blob(f, documents, int(old_offsets[-1]))
+    _write_offsets(np.concatenate((old_offsets, ends)), offsets_path)
+
+
+class MappedDocuments(Sequence):
+    """Read-only list of documents, decoded on access from a memory-mapped blob."""
+
+    def __init__(self, data_path, offsets_path):
+        self._offsets = np.load(offsets_path)
+        # np.memmap cannot map an empty file
+        if self._offsets[-1] > 0:
+            self._data = np.memmap(data_path, dtype=np.uint8, mode='r')
+        else:
+            self._data = np.empty(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("document index out of range")
+        return self._data[self._offsets[i]:self._offsets[i + 1]].tobytes().decode('utf-8')
@@ -1,7 +1,93 @@
+import math
+import numpy as np
 import faiss
 
-def build_faiss_index(embeddings):
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
+_gpu_resources = None
+
+# PQ code sizes (bytes per vector) that GpuIndexIVFPQ implements
+_GPU_PQ_SIZES = (1, 2, 3, 4, 8, 12, 16, 20, 24, 28, 32, 40, 48, 56, 64)
+
+
+def index_to_gpu(index):
+    """Move an index to the first GPU when faiss-gpu and a device are available."""
+    global _gpu_resources
+    if not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return index
+    if _gpu_resources is None:
+        # Must outlive every index cloned onto the GPU
+        _gpu_resources = faiss.StandardGpuResources()
+    options = faiss.GpuClonerOptions()
+    ivf = faiss.try_extract_index_ivf(index)
+    # Above ~48 bytes per code the float32 PQ lookup tables exceed GPU shared memory;
+    # float16 tables cost nothing next to the PQ error. (For flat layouts this flag
+    # would store the vectors themselves in float16, so it is left off there.)
+    options.useFloat16 = ivf is not None and isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ)
+    try:
+        return faiss.index_cpu_to_gpu(_gpu_resources, 0, index, options)
+    except RuntimeError as e:
+        # Not every index layout has a GPU implementation (e.g. large PQ codes)
+        print(f"Keeping FAISS index on CPU: {e}")
+        return index
+
+
+def index_to_cpu(index):
+    """Return a CPU copy of an index that index_to_gpu may have moved; serialization is CPU-only."""
+    # Composite layouts come back as CPU wrappers (e.g. IndexPreTransform) around GPU
+    # sub-indexes, so check for GPU faiss rather than the type of the outer index.
+    if hasattr(faiss, "index_gpu_to_cpu") and faiss.get_num_gpus() > 0:
+        return faiss.index_gpu_to_cpu(index)
+    return index
+
+
+def default_factory_string(num_vectors, dimension):
+    """Pick an index layout for a corpus of num_vectors embeddings."""
+    nlist = max(1, int(4 * math.sqrt(num_vectors)))
+    # PQ needs 256 points per codebook and IVF ~39 per list to train; below
+    # that an exhaustive flat search is both cheaper and exact.
+    if num_vectors < max(256, 39 * nlist):
+        return "Flat"
+    # Largest GPU-supported code size up to 64 bytes (dimension // 4 for small
+    # models) that splits the vectors evenly, e.g. OPQ64_768,...,PQ64
+    m = max(size for size in _GPU_PQ_SIZES
+            if size <= max(1, min(64, dimension // 4)) and dimension % size == 0)
+    # OPQ rotation + HNSW coarse quantizer: better recall than plain IVFPQ at the same code size
+    return f"OPQ{m}_{dimension},IVF{nlist}_HNSW32,PQ{m}"
+
+
+def create_faiss_index(num_vectors, dimension, factory_string=None, metric=faiss.METRIC_INNER_PRODUCT):
+    """Create an empty, possibly untrained, index sized for num_vectors embeddings."""
+    if factory_string is None:
+        factory_string = default_factory_string(num_vectors, dimension)
+    return faiss.index_factory(dimension, factory_string, metric)
+
+
+def sample_training_ids(num_vectors, max_train_points=100000):
+    """Sorted row ids of a random training sample of at most max_train_points rows."""
+    if num_vectors <= max_train_points:
+        return np.arange(num_vectors)
+    return np.sort(np.random.choice(num_vectors, max_train_points, replace=False))
+
+
+def set_search_parameters(index, nprobe=32, ef_search=64):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return
+    params = f"nprobe={nprobe}"
+    if isinstance(faiss.downcast_index(ivf.quantizer), faiss.IndexHNSW):
+        params += f",quantizer_efSearch={ef_search}"
+    faiss.ParameterSpace().set_index_parameters(index, params)
+
+
+def build_faiss_index(embeddings, factory_string=None, nprobe=32, ef_search=64,
+                      max_train_points=100000, metric=faiss.METRIC_INNER_PRODUCT):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    num_vectors, dimension = embeddings.shape
+    index = create_faiss_index(num_vectors, dimension, factory_string, metric)
+    if not index.is_trained:
+        training_set = embeddings
+        if num_vectors > max_train_points:
+            training_set = embeddings[sample_training_ids(num_vectors, max_train_points)]
+        index.train(training_set)
     index.add(embeddings)
-    return index 
\ No newline at end of file
+    set_search_parameters(index, nprobe, ef_search)
+    return index_to_gpu(index)
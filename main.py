@@ -15,14 +15,14 @@ def setup_rag_pipeline(sources, model_name='sentence-transformers/bert-base-nli-
     print(f"Loaded {len(documents)} chunks from {len(sources)} sources")
     
     print("Loading embedding model...")
-    tokenizer, model = load_embedder(model_name)
-    doc_embeddings = get_embeddings(documents, tokenizer, model)
+    model = load_embedder(model_name)
+    doc_embeddings = get_embeddings(documents, model)
     
     print("Building FAISS index...")
     index = build_faiss_index(doc_embeddings)
     
     def dspy_retrieval_model(query, k=5):
-        return retrieval_model(query, k, tokenizer, model, index, documents, get_embeddings)
+        return retrieval_model(query, k, model, index, documents, get_embeddings)
     
     print("Setting up DSPy...")
     from huggingface_hub import login
@@ -24,7 +24,6 @@ class RAGManager:
         
         # Initialize components
         self.documents = None
-        self.tokenizer = None
         self.model = None
         self.index = None
         self.rag = None
@@ -40,14 +39,14 @@ class RAGManager:
         print(f"Loaded {len(self.documents)} chunks from {len(self.sources)} sources")
         
         print("Loading embedding model...")
-        self.tokenizer, self.model = load_embedder(self.model_name)
-        doc_embeddings = get_embeddings(self.documents, self.tokenizer, self.model)
+        self.model = load_embedder(self.model_name)
+        doc_embeddings = get_embeddings(self.documents, self.model)
         
         print("Building FAISS index...")
         self.index = build_faiss_index(doc_embeddings)
         
         def dspy_retrieval_model(query, k=5):
-            return retrieval_model(query, k, self.tokenizer, self.model, self.index, self.documents, get_embeddings)
+            return retrieval_model(query, k, self.model, self.index, self.documents, get_embeddings)
         
         print("Setting up DSPy...")
         from huggingface_hub import login
@@ -5,7 +5,8 @@ class RAG(dspy.Module):
         super().__init__()
         self.retrieve = dspy.Retrieve(k=num_passages)
         self.generate_answer = dspy.ChainOfThought("context, question -> answer")
-    def forward(self, question):
-        context = self.retrieve(question).passages
+    def forward(self, question, context=None):
+        if context is None:
+            context = self.retrieve(question).passages
         prediction = self.generate_answer(context=context, question=question)
         return dspy.Prediction(context=context, answer=prediction.answer) 
\ No newline at end of file
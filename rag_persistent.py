@@ -1,14 +1,35 @@
 import dspy
+import functools
+import glob
+import hashlib
 import pickle
 import os
 import numpy as np
-from data_loader import load_corpus
-from chunker import chunk_text
-from embedder import load_embedder, get_embeddings
-from faiss_index import build_faiss_index
-from retriever import retrieval_model
+from data_loader import iter_corpus
+from chunker import iter_chunks
+from document_store import save_documents, append_documents, MappedDocuments
+from embedder import load_embedder, embedder_precision, get_embeddings, tokenize_texts, embed_token_ids
+from faiss_index import (default_factory_string, create_faiss_index, sample_training_ids,
+                         set_search_parameters, index_to_cpu, index_to_gpu)
+from retriever import search_passages
 from rag_module import RAG
 
+# Documents embedded and added to the index per step while building
+INDEX_BATCH_SIZE = 4096
+
+
+def _replace_file(path, write):
+    """Write a file under a temporary name and atomically move it into place."""
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _pipeline_signature(model_name, factory_string):
+    """Fingerprint of the settings a cached index is only valid for."""
+    return hashlib.sha256(f"{model_name}\n{factory_string}".encode('utf-8')).hexdigest()
+
+
 class PersistentRAGManager:
     """Persistent RAG manager that can save/load pipeline state."""
     
@@ -17,94 +38,199 @@ class PersistentRAGManager:
         Initialize persistent RAG manager.
         
         Args:
-            cache_dir (str): Directory to store cached embeddings and index
+            cache_dir (str): Directory to store cached documents and index
         """
         self.cache_dir = cache_dir
         os.makedirs(cache_dir, exist_ok=True)
         
         # Components that will be loaded/saved
         self.documents = None
-        self.tokenizer = None
         self.model = None
         self.index = None
         self.rag = None
         self.sources = None
         self.model_name = None
+        self.corpus_name = None
+        self.factory_string = None
+        
+        # Repeated questions skip the encoder entirely
+        self._embed_query = functools.lru_cache(maxsize=1024)(self._encode_query)
         
     def _get_cache_paths(self, corpus_name):
         """Get file paths for cached components."""
         base_path = os.path.join(self.cache_dir, corpus_name)
         return {
-            'documents': f"{base_path}_documents.pkl",
-            'embeddings': f"{base_path}_embeddings.npy",
+            'documents': f"{base_path}_documents.bin",
+            'offsets': f"{base_path}_offsets.npy",
             'index': f"{base_path}_index.faiss",
             'metadata': f"{base_path}_metadata.pkl"
         }
     
-    def _save_pipeline(self, corpus_name, documents, embeddings, index, sources, model_name):
-        """Save pipeline components to disk."""
-        paths = self._get_cache_paths(corpus_name)
+    def _get_cached_tokens(self, documents, corpus_name, model_name, write=False):
+        """
+        Token ids for documents, cached on disk per (model, corpus contents).
         
-        # Save documents
-        with open(paths['documents'], 'wb') as f:
-            pickle.dump(documents, f)
+        Rebuilding a corpus with the same model (e.g. with another index layout)
+        then skips the tokenizer entirely.
         
-        # Save embeddings
-        np.save(paths['embeddings'], embeddings)
+        Args:
+            documents (list): Document chunks
+            corpus_name (str): Name of the corpus
+            model_name (str): Embedding model name
+            write (bool): Tokenize and store the cache if there is none yet
+            
+        Returns:
+            tuple: (token_ids, lengths) with row i's tokens in token_ids[i, :lengths[i]],
+                or None if nothing is cached and write is False
+        """
+        model_key = hashlib.sha256(model_name.encode('utf-8')).hexdigest()[:16]
+        prefix = os.path.join(self.cache_dir, f"{corpus_name}_tokens_{model_key}_")
+        existing = glob.glob(f"{glob.escape(prefix)}*.npy")
+        if not existing and not write:
+            return None
+        
+        digest = hashlib.sha256()
+        for document in documents:
+            digest.update(document.encode('utf-8'))
+            digest.update(b'\0')
+        base_path = f"{prefix}{digest.hexdigest()[:16]}"
+        ids_path, lengths_path = f"{base_path}_token_ids.npy", f"{base_path}_token_lengths.npy"
+        
+        if not (os.path.exists(ids_path) and os.path.exists(lengths_path)):
+            if not write:
+                return None
+            # Token caches of earlier versions of this corpus are no longer useful
+            for stale_path in existing:
+                os.remove(stale_path)
+            
+            print("Tokenizing documents...")
+            # Fixed width so rows can be sliced from the memory map; true lengths are kept alongside
+            shape = (len(documents), self.model.max_seq_length)
+            tmp_ids_path = f"{base_path}.tmp_ids.npy"
+            token_ids = np.lib.format.open_memmap(tmp_ids_path, mode='w+', dtype=np.int32, shape=shape)
+            lengths = np.zeros(len(documents), dtype=np.int32)
+            for start in range(0, len(documents), INDEX_BATCH_SIZE):
+                for row, ids in enumerate(tokenize_texts(documents[start:start + INDEX_BATCH_SIZE], self.model),
+                                          start=start):
+                    token_ids[row, :len(ids)] = ids
+                    lengths[row] = len(ids)
+            token_ids.flush()
+            del token_ids
+            
+            def write_lengths(path):
+                with open(path, 'wb') as f:
+                    np.save(f, lengths)
+            # Only publish complete caches
+            os.replace(tmp_ids_path, ids_path)
+            _replace_file(lengths_path, write_lengths)
+        
+        return np.load(ids_path, mmap_mode='r'), np.load(lengths_path)
+    
+    def _embed_documents(self, documents, rows, tokens=None):
+        """Embed documents[rows], from cached token ids when available."""
+        if tokens is None:
+            return get_embeddings([documents[i] for i in rows], self.model)
+        token_ids, lengths = tokens
+        return embed_token_ids([token_ids[i, :lengths[i]].tolist() for i in rows], self.model)
+    
+    def _save_pipeline(self, corpus_name, index, sources, model_name, factory_string):
+        """Save the index and metadata; the documents are already written as they are chunked."""
+        paths = self._get_cache_paths(corpus_name)
         
         # Save FAISS index
         import faiss
-        faiss.write_index(index, paths['index'])
+        cpu_index = index_to_cpu(index)
+        _replace_file(paths['index'], lambda path: faiss.write_index(cpu_index, path))
         
         # Save metadata
         metadata = {
             'sources': sources,
             'model_name': model_name,
-            'num_documents': len(documents),
-            'embedding_dim': embeddings.shape[1]
+            'factory_string': factory_string,
+            'signature': _pipeline_signature(model_name, factory_string),
+            'encoder_precision': embedder_precision(self.model),
+            'num_documents': index.ntotal,
+            'embedding_dim': index.d
         }
-        with open(paths['metadata'], 'wb') as f:
-            pickle.dump(metadata, f)
+        
+        def write_metadata(path):
+            with open(path, 'wb') as f:
+                pickle.dump(metadata, f)
+        _replace_file(paths['metadata'], write_metadata)
         
         print(f"Pipeline saved to {self.cache_dir}/{corpus_name}_*")
     
-    def _load_pipeline(self, corpus_name):
-        """Load pipeline components from disk."""
+    def _load_pipeline(self, corpus_name, model_name, factory_string=None):
+        """
+        Load pipeline components from disk.
+        
+        Returns False if nothing is cached for corpus_name. A cache that exists but
+        cannot be used raises instead, so it is never silently rebuilt over.
+        """
         paths = self._get_cache_paths(corpus_name)
         
-        # Check if all files exist
-        for path in paths.values():
-            if not os.path.exists(path):
-                return False
+        # Nothing cached for this corpus yet
+        if not os.path.exists(paths['metadata']):
+            return False
+        
+        with open(paths['metadata'], 'rb') as f:
+            metadata = pickle.load(f)
+        
+        missing = [os.path.basename(path) for path in paths.values() if not os.path.exists(path)]
+        if missing or 'signature' not in metadata:
+            raise ValueError(
+                f"Cached pipeline '{corpus_name}' is incomplete or was written by an older version "
+                f"(missing: {', '.join(missing) or 'signature'}). Rebuild it with "
+                f"build_pipeline(sources, '{corpus_name}', force_rebuild=True)."
+            )
+        
+        # An index built by another model or layout would return wrong neighbours
+        expected = _pipeline_signature(model_name, factory_string or metadata['factory_string'])
+        if metadata['signature'] != expected:
+            raise ValueError(
+                f"Cached pipeline '{corpus_name}' was built with model '{metadata['model_name']}' "
+                f"and index '{metadata['factory_string']}', which do not match the requested settings. "
+                f"Pass the matching model_name/factory_string, or rebuild with force_rebuild=True."
+            )
         
+        # Map documents; each chunk is only decoded when it is retrieved
+        self.documents = MappedDocuments(paths['documents'], paths['offsets'])
+        
+        # Load FAISS index
+        import faiss
+        self.index = index_to_gpu(faiss.read_index(paths['index']))
+        
+        # Each file is replaced atomically, but an interrupted update can leave them
+        # out of step with each other
+        if not len(self.documents) == self.index.ntotal == metadata['num_documents']:
+            raise ValueError(
+                f"Cached pipeline '{corpus_name}' is inconsistent ({len(self.documents)} documents, "
+                f"{self.index.ntotal} vectors); rebuild it with force_rebuild=True."
+            )
+        
+        self.sources = metadata['sources']
+        self.model_name = metadata['model_name']
+        self.factory_string = metadata['factory_string']
+        self.corpus_name = corpus_name
+        
+        # Load embedder from the local HuggingFace cache; only go to the hub if it is missing
         try:
-            # Load documents
-            with open(paths['documents'], 'rb') as f:
-                self.documents = pickle.load(f)
-            
-            # Load embeddings
-            embeddings = np.load(paths['embeddings'])
-            
-            # Load FAISS index
-            import faiss
-            self.index = faiss.read_index(paths['index'])
-            
-            # Load metadata
-            with open(paths['metadata'], 'rb') as f:
-                metadata = pickle.load(f)
-            
-            self.sources = metadata['sources']
-            self.model_name = metadata['model_name']
-            
-            print(f"Pipeline loaded from cache: {len(self.documents)} documents")
-            return True
-            
-        except Exception as e:
-            print(f"Error loading pipeline: {e}")
-            return False
+            self.model = load_embedder(self.model_name, local_files_only=True)
+        except OSError:
+            self.model = load_embedder(self.model_name)
+        
+        # An fp16 (GPU), int8 (CPU) or float32 encoder gives slightly different vectors
+        built_with = metadata.get('encoder_precision')
+        if built_with is not None and built_with != embedder_precision(self.model):
+            print(f"Warning: the index of '{corpus_name}' was embedded by a {built_with} encoder, but "
+                  f"queries will be embedded by a {embedder_precision(self.model)} one; retrieval may "
+                  f"be slightly less accurate.")
+        
+        print(f"Pipeline loaded from cache: {len(self.documents)} documents")
+        return True
     
     def build_pipeline(self, sources, corpus_name, model_name='sentence-transformers/bert-base-nli-mean-tokens', 
-                      hf_token='YOUR_HF_TOKEN', force_rebuild=False):
+                      hf_token='YOUR_HF_TOKEN', force_rebuild=False, factory_string=None, cache_tokens=None):
         """
         Build or load RAG pipeline.
         
@@ -114,33 +240,120 @@ class PersistentRAGManager:
             model_name (str): Embedding model name
             hf_token (str): HuggingFace token
             force_rebuild (bool): Force rebuild even if cache exists
+            factory_string (str): FAISS index_factory layout (chosen from corpus size if None)
+            cache_tokens (bool): Store tokenized documents for later rebuilds (by default
+                only when an existing corpus is rebuilt)
+        
+        Raises:
+            ValueError: If the cached corpus does not match the requested settings, or
+                a build is needed but no sources were given
         """
+        # Cached query embeddings belong to the previous model
+        self._embed_query.cache_clear()
+        
         # Try to load from cache first
-        if not force_rebuild and self._load_pipeline(corpus_name):
+        if not force_rebuild and self._load_pipeline(corpus_name, model_name, factory_string):
             print("Using cached pipeline")
         else:
+            if not sources:
+                raise ValueError(f"No cached pipeline '{corpus_name}' to load and no sources to build it from.")
+            if cache_tokens is None:
+                # A corpus that is rebuilt once is likely to be rebuilt again
+                cache_tokens = os.path.exists(self._get_cache_paths(corpus_name)['metadata'])
             print("Building new pipeline...")
-            self._build_new_pipeline(sources, corpus_name, model_name, hf_token)
+            self._build_new_pipeline(sources, corpus_name, model_name, hf_token, factory_string, cache_tokens)
     
-    def _build_new_pipeline(self, sources, corpus_name, model_name, hf_token):
+    def _build_new_pipeline(self, sources, corpus_name, model_name, hf_token, factory_string=None,
+                            cache_tokens=False):
         """Build a new pipeline from scratch."""
+        paths = self._get_cache_paths(corpus_name)
+        # Without metadata, an interrupted rebuild leaves nothing that looks loadable
+        if os.path.exists(paths['metadata']):
+            os.remove(paths['metadata'])
+        
         print("Loading data...")
-        corpus = load_corpus(sources)
-        self.documents = chunk_text(corpus)
+        # Each source's text is chunked as it arrives and the chunks go straight to disk;
+        # there is no joined corpus string and no in-memory list of chunks
+        save_documents(iter_chunks(iter_corpus(sources)), paths['documents'], paths['offsets'])
+        self.documents = MappedDocuments(paths['documents'], paths['offsets'])
         print(f"Loaded {len(self.documents)} chunks from {len(sources)} sources")
         
         print("Loading embedding model...")
-        self.tokenizer, self.model = load_embedder(model_name)
-        embeddings = get_embeddings(self.documents, self.tokenizer, self.model)
+        self.model = load_embedder(model_name)
+        dimension = self.model.get_sentence_embedding_dimension()
         
         print("Building FAISS index...")
-        self.index = build_faiss_index(embeddings)
+        if factory_string is None:
+            factory_string = default_factory_string(len(self.documents), dimension)
+        index = create_faiss_index(len(self.documents), dimension, factory_string)
+        tokens = self._get_cached_tokens(self.documents, corpus_name, model_name, write=cache_tokens)
+        
+        # The training sample is embedded once and its vectors are reused when adding.
+        # It has at most max_train_points rows whatever the corpus size; apart from it
+        # only the current batch of vectors is in memory.
+        sample = np.empty(0, dtype=np.int64)
+        if not index.is_trained:
+            sample = sample_training_ids(len(self.documents))
+        sample_embeddings = self._embed_documents(self.documents, sample, tokens)
+        if not index.is_trained:
+            index.train(sample_embeddings)
+        sample_position = np.full(len(self.documents), -1, dtype=np.int64)
+        sample_position[sample] = np.arange(len(sample))
+        
+        # Embed and index batch by batch, reading the chunks from the memory map
+        for start in range(0, len(self.documents), INDEX_BATCH_SIZE):
+            rows = np.arange(start, min(start + INDEX_BATCH_SIZE, len(self.documents)))
+            positions = sample_position[rows]
+            in_sample = positions >= 0
+            batch_embeddings = np.empty((len(rows), dimension), dtype=np.float32)
+            batch_embeddings[in_sample] = sample_embeddings[positions[in_sample]]
+            if not in_sample.all():
+                batch_embeddings[~in_sample] = self._embed_documents(self.documents, rows[~in_sample], tokens)
+            index.add(batch_embeddings)
+        
+        set_search_parameters(index)
+        self.index = index_to_gpu(index)
         
         # Save to cache
-        self._save_pipeline(corpus_name, self.documents, embeddings, self.index, sources, model_name)
+        self._save_pipeline(corpus_name, self.index, sources, model_name, factory_string)
         
         self.sources = sources
         self.model_name = model_name
+        self.factory_string = factory_string
+        self.corpus_name = corpus_name
+    
+    def update_pipeline(self, new_sources):
+        """
+        Add sources to the loaded corpus, reusing the trained index.
+        
+        Only the new chunks are embedded; the coarse quantizer and PQ codebooks
+        are kept as they are. Use build_pipeline(force_rebuild=True) to retrain.
+        
+        Args:
+            new_sources (list): Additional file paths
+        """
+        if self.index is None:
+            raise ValueError("Pipeline not loaded. Call build_pipeline() first.")
+        
+        print("Loading new data...")
+        new_documents = list(iter_chunks(iter_corpus(new_sources)))
+        print(f"Loaded {len(new_documents)} chunks from {len(new_sources)} sources")
+        
+        print("Adding to FAISS index...")
+        for start in range(0, len(new_documents), INDEX_BATCH_SIZE):
+            rows = range(start, min(start + INDEX_BATCH_SIZE, len(new_documents)))
+            self.index.add(self._embed_documents(new_documents, rows))
+        
+        # Existing chunks stay on disk; only the new ones are appended
+        paths = self._get_cache_paths(self.corpus_name)
+        append_documents(new_documents, paths['documents'], paths['offsets'])
+        self.sources = list(self.sources) + list(new_sources)
+        self._save_pipeline(self.corpus_name, self.index, self.sources, self.model_name, self.factory_string)
+        self.documents = MappedDocuments(paths['documents'], paths['offsets'])
+    
+    def _encode_query(self, query):
+        """Embed a single query (use the cached self._embed_query instead)."""
+        return get_embeddings([query], self.model)
     
     def setup_dspy(self, hf_token='YOUR_HF_TOKEN'):
         """Setup DSPy components (needs to be done in each session)."""
@@ -148,7 +361,7 @@ class PersistentRAGManager:
             raise ValueError("Pipeline not loaded. Call build_pipeline() first.")
         
         def dspy_retrieval_model(query, k=5):
-            return retrieval_model(query, k, self.tokenizer, self.model, self.index, self.documents, get_embeddings)
+            return search_passages(self._embed_query(query), k, self.index, self.documents)[0]
         
         print("Setting up DSPy...")
         from huggingface_hub import login
@@ -159,13 +372,13 @@ class PersistentRAGManager:
         self.rag = RAG(num_passages=3)
         print("DSPy ready!")
     
-    def ask(self, question):
-        """Ask a question."""
+    def ask(self, question, context=None):
+        """Ask a question, optionally with already retrieved context passages."""
         if self.rag is None:
             raise ValueError("DSPy not setup. Call setup_dspy() first.")
         
         try:
-            response = self.rag(question)
+            response = self.rag(question, context=context)
             return {
                 'answer': response.answer,
                 'context': response.context,
@@ -178,6 +391,36 @@ class PersistentRAGManager:
                 'num_passages': 0
             }
     
+    def ask_batch(self, questions):
+        """
+        Ask several questions, embedding and retrieving for all of them at once.
+        
+        The batch is embedded in one pass and does not go through the query
+        embedding cache that ask() uses, so repeated questions are re-encoded.
+        
+        Args:
+            questions (list): Questions to ask
+            
+        Returns:
+            list: One result dict per question, in the same format as ask()
+        """
+        if self.rag is None:
+            raise ValueError("DSPy not setup. Call setup_dspy() first.")
+        if not questions:
+            return []
+        
+        # One encoder forward pass and one index search for the whole batch
+        try:
+            query_embeddings = get_embeddings(list(questions), self.model)
+            passages = search_passages(query_embeddings, self.rag.retrieve.k, self.index, self.documents)
+        except Exception:
+            # Fall back to one question at a time, so each gets its own answer or error dict
+            return [self.ask(question) for question in questions]
+        return [
+            self.ask(question, context=[p.long_text for p in question_passages])
+            for question, question_passages in zip(questions, passages)
+        ]
+    
     def get_info(self):
         """Get information about the loaded corpus."""
         if self.documents is None:
@@ -228,9 +471,8 @@ if __name__ == "__main__":
         "How does Heidegger define Dasein?"
     ]
     
-    for question in questions:
+    for question, result in zip(questions, rag.ask_batch(questions)):
         print(f"\nQuestion: {question}")
-        result = rag.ask(question)
         print(f"Answer: {result['answer']}")
         print(f"Retrieved {result['num_passages']} passages")
         print("-" * 50) 
\ No newline at end of file
@@ -1,5 +1,22 @@
-def retrieval_model(query, k, tokenizer, model, index, documents, get_embeddings):
-    query_embedding = get_embeddings([query], tokenizer, model)
-    _, indices = index.search(query_embedding, k)
-    retrieved_passages = [type('Passage', (object,), {'long_text': documents[idx]})() for idx in indices[0]]
-    return retrieved_passages 
\ No newline at end of file
+import numpy as np
+
+
+class Passage:
+    """A retrieved chunk, in the shape DSPy expects from a retrieval model."""
+    __slots__ = ('long_text',)
+
+    def __init__(self, long_text):
+        self.long_text = long_text
+
+
+def search_passages(query_embeddings, k, index, documents):
+    # FAISS silently copies anything that is not C-contiguous float32
+    query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+    _, indices = index.search(query_embeddings, k)
+    # IVF indexes pad with -1 when fewer than k neighbours are found
+    return [[Passage(documents[idx]) for idx in row if idx >= 0] for row in indices.tolist()]
+
+
+def retrieval_model(query, k, model, index, documents, get_embeddings):
+    query_embedding = get_embeddings([query], model)
+    return search_passages(query_embedding, k, index, documents)[0]